@@ -1,6 +1,6 @@
 from pydantic import Field
 import ssl
-import certifi
+from fakts.grants.remote.utils import get_default_ssl_context
 import aiohttp
 from typing import Dict
 from fakts.grants.remote.errors import ClaimError
@@ -19,7 +19,7 @@ class ClaimEndpointClaimer(BaseModel):
     """
 
     ssl_context: ssl.SSLContext = Field(
-        default_factory=lambda: ssl.create_default_context(cafile=certifi.where()),
+        default_factory=get_default_ssl_context,
         exclude=True,
     )
     """ An ssl context to use for the connection to the endpoint"""
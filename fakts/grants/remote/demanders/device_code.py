@@ -11,7 +11,7 @@ from fakts.grants.remote import FaktsEndpoint
 from fakts.grants.remote.errors import DemandError
 
 import ssl
-import certifi
+from fakts.grants.remote.utils import get_default_ssl_context
 from typing import List
 from enum import Enum
 from .utils import print_device_code_prompt, print_succesfull_login
@@ -56,7 +56,7 @@ class DeviceCodeDemander(BaseModel):
     """
 
     ssl_context: ssl.SSLContext = Field(
-        default_factory=lambda: ssl.create_default_context(cafile=certifi.where()),
+        default_factory=get_default_ssl_context,
         exclude=True,
     )
     manifest: BaseModel
@@ -5,7 +5,7 @@ import logging
 from fakts.grants.remote.errors import DemandError
 from fakts.grants.remote.models import FaktsEndpoint, FaktsRequest
 import ssl
-import certifi
+from fakts.grants.remote.utils import get_default_ssl_context
 
 logger = logging.getLogger(__name__)
 
@@ -27,7 +27,7 @@ class RetrieveDemander(BaseModel):
     """
 
     ssl_context: ssl.SSLContext = Field(
-        default_factory=lambda: ssl.create_default_context(cafile=certifi.where()),
+        default_factory=get_default_ssl_context,
         exclude=True,
     )
     """ An ssl context to use for the connection to the endpoint"""
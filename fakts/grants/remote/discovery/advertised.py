@@ -1,39 +1,83 @@
-from typing import Dict, AsyncGenerator, List, Tuple
-
-from pydantic import Field
-from socket import socket, AF_INET, SOCK_DGRAM
+from typing import (
+    Any,
+    Dict,
+    AsyncGenerator,
+    AsyncIterator,
+    Deque,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from pydantic import Field, PrivateAttr
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_RCVBUF
 import asyncio
-import json
 import logging
+import time
 from pydantic import BaseModel
 import ssl
-import certifi
+from fakts.grants.remote.utils import get_default_ssl_context
 from .utils import discover_url
 from fakts.grants.remote.models import FaktsEndpoint, FaktsRequest
 from fakts.grants.remote.errors import DiscoveryError
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    import json
+
+    def json_loads(payload: Union[bytes, memoryview]) -> Any:  # type: ignore
+        """Load json from bytes or a memoryview (which json can't read)"""
+        return json.loads(bytes(payload))
+
+
 logger = logging.getLogger(__name__)
 
+MAX_PENDING_DATAGRAMS = 1024
+"""How many datagrams a shared listener buffers for every discovery"""
+MAX_DATAGRAM_SIZE = 8192
+"""The maximum size of a received datagram (larger ones are truncated)"""
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+"""The requested kernel receive buffer of a listening socket"""
+
 
 class DiscoveryProtocol(asyncio.DatagramProtocol):
-    "The protocol that is used to receive beacons, and put them in a queue"
+    "The protocol that is used to receive beacons, and buffer them for consumers"
 
-    def __init__(self, recvq: asyncio.Queue) -> None:
+    def __init__(self, magic_phrase: bytes, maxlen: Optional[int] = None) -> None:
         """Initialize the protocol
 
         Parameters
         ----------
-        recvq : asyncio.Queue
-            The queue to put the beacons in
+        magic_phrase : bytes
+            The (encoded) magic phrase that every beacon starts with
+        maxlen : Optional[int], optional
+            How many payloads to buffer at most for every consumer (the
+            oldest are dropped first), by default None (unbounded)
         """
         super().__init__()
-        self._recvq = recvq
+        self._magic = magic_phrase
+        self._magic_len = len(magic_phrase)
+        self._maxlen = maxlen
+        self._pending: Deque[Tuple[memoryview, Tuple[str, int]]] = deque(maxlen=maxlen)
+        self._consumers: List[
+            Tuple[Deque[Tuple[memoryview, Tuple[str, int]]], asyncio.Event]
+        ] = []
+        self._closed = False
 
     def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
         """Receive a datagram
 
-        This method is called when a datagram is received, and
-        puts it in the queue
+        This method is called when a datagram is received. Datagrams that
+        do not start with the magic phrase are dropped right away, for all
+        others the payload after the magic phrase is buffered for every
+        consumer (as a memoryview, so it is not copied). Consumers are woken
+        up by an event, so a burst of datagrams only wakes them once. While
+        nobody consumes, the payloads are kept for the next consumer.
 
         Parameters
         ----------
@@ -42,10 +86,184 @@ class DiscoveryProtocol(asyncio.DatagramProtocol):
         addr : Tuple[str, int]
             The address it was received from
         """
-        self._recvq.put_nowait((data, addr))
+        if not data.startswith(self._magic):
+            logger.debug("Received Non Magic Response %r. Maybe somebody sends", data)
+            return
+
+        payload = (memoryview(data)[self._magic_len :], addr)
+        if not self._consumers:
+            self._pending.append(payload)
+            return
+
+        for payloads, received in self._consumers:
+            payloads.append(payload)
+            received.set()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        """Stop the consumers once the transport is closed
+
+        Parameters
+        ----------
+        exc : Optional[Exception]
+            The exception that closed the transport (if any)
+        """
+        self._closed = True
+        for _, received in self._consumers:
+            received.set()
+
+    def clear(self) -> None:
+        """Drop the payloads that were kept while nobody consumed"""
+        self._pending.clear()
+
+    async def areceive(
+        self,
+    ) -> AsyncGenerator[Tuple[memoryview, Tuple[str, int]], None]:
+        """Yield the payloads of the received beacons
+
+        All payloads buffered since the last wakeup are yielded in one go.
+        Several consumers can iterate at the same time, every one of them
+        sees every payload received while it iterates (the first one also
+        gets the payloads kept while nobody consumed). Iteration stops once
+        the transport is closed.
+
+        Yields
+        ------
+        Tuple[memoryview, Tuple[str, int]]
+            The payload (without the magic phrase) and the address it
+            was received from
+        """
+        payloads: Deque[Tuple[memoryview, Tuple[str, int]]] = deque(maxlen=self._maxlen)
+        if not self._consumers:
+            payloads.extend(self._pending)
+            self._pending.clear()
+
+        received = asyncio.Event()
+        consumer = (payloads, received)
+        self._consumers.append(consumer)
+
+        try:
+            while True:
+                while payloads:
+                    yield payloads.popleft()
+
+                if self._closed:
+                    return
+
+                received.clear()
+                await received.wait()
+        finally:
+            self._consumers.remove(consumer)
+
+
+class BatchedDatagramTransport(asyncio.BaseTransport):
+    """A minimal transport that drains a datagram socket in batches
+
+    The datagram transport of asyncio reads a single datagram every time
+    the socket becomes readable. This transport instead reads all pending
+    datagrams (up to `max_batch`) per wakeup and hands them to the protocol,
+    so bursts of beacons cost a single turn of the event loop.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        sock: socket,
+        protocol: asyncio.DatagramProtocol,
+        max_batch: int = 64,
+    ) -> None:
+        """Initialize the transport and start reading
+
+        Parameters
+        ----------
+        loop : asyncio.AbstractEventLoop
+            The loop to read in
+        sock : socket
+            The bound, non blocking socket to read from
+        protocol : asyncio.DatagramProtocol
+            The protocol to hand the datagrams to
+        max_batch : int, optional
+            How many datagrams to read per wakeup at most, by default 64
+
+        Raises
+        ------
+        NotImplementedError
+            If the loop does not support `add_reader` (e.g. the proactor
+            event loop on windows)
+        """
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._fileno = sock.fileno()
+        self._protocol = protocol
+        self._max_batch = max_batch
+        self._closing = False
+        loop.add_reader(self._fileno, self._drain)
+
+    def _drain(self) -> None:
+        for _ in range(self._max_batch):
+            try:
+                data, addr = self._sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self._protocol.error_received(e)
+                return
+
+            self._protocol.datagram_received(data, addr)
+
+    def is_closing(self) -> bool:
+        """Is the transport closed (or closing)"""
+        return self._closing
+
+    def close(self) -> None:
+        """Stop reading from the socket (the socket itself is not closed)
+
+        Like the transports of asyncio, the protocol is notified through
+        `connection_lost` on the next turn of the loop.
+        """
+        if not self._closing:
+            self._closing = True
+            self._loop.remove_reader(self._fileno)
+            self._loop.call_soon(self._protocol.connection_lost, None)
+
 
+async def acreate_listener(
+    loop: asyncio.AbstractEventLoop, sock: socket, protocol: asyncio.DatagramProtocol
+) -> asyncio.BaseTransport:
+    """Start handing the datagrams received on the socket to the protocol
 
-class ListenBinding(BaseModel):
+    This will use a BatchedDatagramTransport, and fall back to the datagram
+    transport of the loop if the loop can not watch the socket itself.
+
+    Parameters
+    ----------
+    loop : asyncio.AbstractEventLoop
+        The loop to read in
+    sock : socket
+        The bound socket to read from
+    protocol : asyncio.DatagramProtocol
+        The protocol to hand the datagrams to
+
+    Returns
+    -------
+    asyncio.BaseTransport
+        The transport, close it to stop reading
+    """
+    sock.setblocking(False)
+    try:
+        sock.setsockopt(SOL_SOCKET, SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+    except OSError as e:
+        logger.info(f"Could not increase the receive buffer: {e}")
+
+    try:
+        return BatchedDatagramTransport(loop, sock, protocol)
+    except NotImplementedError:
+        transport, _ = await loop.create_datagram_endpoint(lambda: protocol, sock=sock)
+        return transport
+
+
+@dataclass(frozen=True)
+class ListenBinding:
     """A binding to listen on for beacons"""
 
     address: str = ""
@@ -53,7 +271,8 @@ class ListenBinding(BaseModel):
     magic_phrase: str = "beacon-fakts"
 
 
-class Beacon(BaseModel):
+@dataclass(frozen=True)
+class Beacon:
     """A beacon that is received when listening on
     a broadcast port"""
 
@@ -61,6 +280,97 @@ class Beacon(BaseModel):
     """The url of the endpoint"""
 
 
+def _parse_beacon_url(payload: Union[bytes, memoryview]) -> str:
+    """Parse the url out of the json payload of a beacon
+
+    The payload only carries a single string, so its shape is checked
+    by hand instead of through a validation library. If orjson is
+    installed it is used to decode the payload.
+    """
+    data = json_loads(payload)
+    if not isinstance(data, dict) or not isinstance(data.get("url"), str):
+        raise ValueError(f"Beacon payload needs a string url, got {data!r}")
+
+    return data["url"]
+
+
+class _RecentlySeen:
+    """A bounded set of hashes, that forgets the least recently seen first"""
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._keys: "OrderedDict[int, None]" = OrderedDict()
+
+    def check_and_add(self, key: int) -> bool:
+        """Remember the key, and return whether it was already remembered"""
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return True
+
+        self._keys[key] = None
+        if len(self._keys) > self._maxsize:
+            self._keys.popitem(last=False)
+        return False
+
+
+async def _areceive_beacons(
+    protocol: DiscoveryProtocol,
+    strict: bool = False,
+    max_seen: Optional[int] = None,
+) -> AsyncGenerator[Beacon, None]:
+    """Yield the beacons of the datagrams the DiscoveryProtocol receives
+
+    If max_seen is set, each beacon url is only yielded once. Payloads that
+    are byte for byte identical to a recently seen one are skipped before
+    they are parsed, other payloads are deduplicated on the parsed url,
+    so no Beacon is built for repeated beacons. Only the hashes of the
+    max_seen most recently seen payloads and urls are remembered, which keeps
+    the memory per entry small and independent of the url length. A (very
+    unlikely) hash collision would hide a beacon until it is forgotten.
+    """
+    seen_payloads = _RecentlySeen(max_seen) if max_seen is not None else None
+    seen_urls = _RecentlySeen(max_seen) if max_seen is not None else None
+
+    async for payload, addr in protocol.areceive():
+        if seen_payloads is not None and seen_payloads.check_and_add(hash(payload)):
+            continue
+
+        try:
+            url = _parse_beacon_url(payload)
+        except (ValueError, RecursionError) as e:
+            # the json fallback raises a RecursionError on deeply nested payloads
+            logger.error("Received Request but it was not a valid beacon")
+            if strict:
+                raise e
+            continue
+
+        if seen_urls is not None and seen_urls.check_and_add(hash(url)):
+            continue
+
+        yield Beacon(url=url)
+
+
+@asynccontextmanager
+async def _alistening(bind: ListenBinding) -> AsyncIterator[DiscoveryProtocol]:
+    """Listen on the binding, and provide the protocol receiving the datagrams"""
+    s = socket(AF_INET, SOCK_DGRAM)  # create UDP socket
+    transport: Optional[asyncio.BaseTransport] = None
+
+    try:
+        s.bind((bind.address, bind.port))
+        loop = asyncio.get_running_loop()
+        protocol = DiscoveryProtocol(bind.magic_phrase.encode("utf-8"))
+        transport = await acreate_listener(loop, s, protocol)
+
+        yield protocol
+
+    finally:
+        if transport is not None:
+            transport.close()
+        s.close()
+        logger.info("Stopped checking")
+
+
 async def alisten(
     bind: ListenBinding, strict: bool = False
 ) -> AsyncGenerator[Beacon, None]:
@@ -89,62 +399,21 @@ async def alisten(
         Any exception that is raised by the socket
     """
 
-    s = socket(AF_INET, SOCK_DGRAM)  # create UDP socket
-    s.bind((bind.address, bind.port))
-
-    try:
-        loop = asyncio.get_event_loop()
-        read_queue = asyncio.Queue()  # type: ignore
-        transport, pr = await loop.create_datagram_endpoint(
-            lambda: DiscoveryProtocol(read_queue), sock=s
-        )
-
-        while True:
-            data, addr = await read_queue.get()
-            try:
-                data = str(data, "utf8")
-                if data.startswith(bind.magic_phrase):
-                    endpoint = data[len(bind.magic_phrase) :]
-
-                    try:
-                        endpoint = json.loads(endpoint)
-                        endpoint = Beacon(**endpoint)
-                        yield endpoint
-
-                    except json.JSONDecodeError as e:
-                        logger.error("Received Request but it was not valid json")
-                        if strict:
-                            raise e
-
-                else:
-                    logger.error(
-                        f"Received Non Magic Response {data}. Maybe somebody sends"
-                    )
-
-            except UnicodeEncodeError as e:
-                logger.error("Couldn't decode received message")
-                if strict:
-                    raise e
-
-    except asyncio.CancelledError as e:
-        transport.close()
-        s.close()
-        logger.info("Stopped checking")
-        raise e
-    finally:
-        transport.close()
-        s.close()
-        logger.info("Stopped checking")
+    async with _alistening(bind) as protocol:
+        async for beacon in _areceive_beacons(protocol, strict):
+            yield beacon
 
 
 async def alisten_pure(
-    bind: ListenBinding, strict: bool = False
+    bind: ListenBinding, strict: bool = False, max_seen: int = 10_000
 ) -> AsyncGenerator[Beacon, None]:
     """A generator that listens on a broadcast port for beacons
 
     This generator listens on a specific binding for beacons.
     It will yield the beacons as it receives, but will only yield
-    each beacon once.
+    each beacon once. Only the `max_seen` most recently seen urls
+    are remembered, so a long running listener does not grow without
+    bound (a forgotten beacon will be yielded again).
 
 
     Parameters
@@ -153,6 +422,8 @@ async def alisten_pure(
         The binding to listen on
     strict : bool, optional
         Should we error on bad Beacons, by default False
+    max_seen : int, optional
+        How many urls to remember for deduplication, by default 10_000
 
 
     Yields
@@ -166,14 +437,9 @@ async def alisten_pure(
         Any exception that is raised by the socket
     """
 
-    already_detected = set()
-
-    async for x in alisten(bind, strict):
-        if x.url not in already_detected:
-            already_detected.add(x.url)
-            yield x
-
-    return
+    async with _alistening(bind) as protocol:
+        async for beacon in _areceive_beacons(protocol, strict, max_seen):
+            yield beacon
 
 
 class FirstAdvertisedDiscovery(BaseModel):
@@ -181,6 +447,19 @@ class FirstAdvertisedDiscovery(BaseModel):
 
     This discovery will listen on a broadcast port for beacons.
     It will then try to connect to the endpoint and return it.
+
+    The listening socket is opened for a discovery (and shared by
+    concurrent discoveries), and closed again once no discovery is
+    running. To keep it open between discoveries, use the discovery
+    as an async context manager:
+
+    ```python
+    async with FirstAdvertisedDiscovery() as discovery:
+        endpoint = await discovery.adiscover(request)
+    ```
+
+    Beacons that arrived before a discovery started are dropped, so
+    advertisers that went away in the meantime are not replayed.
     """
 
     broadcast_port = 45678
@@ -190,10 +469,18 @@ class FirstAdvertisedDiscovery(BaseModel):
     """The address to bind to"""
     strict: bool = False
     """Should we error on bad Beacons"""
+    max_seen: int = Field(
+        default=10_000,
+        description="How many beacon urls to remember when deduplicating beacons",
+    )
     discovered_endpoints: Dict[str, FaktsEndpoint] = Field(default_factory=dict)
-    """A cache of discovered endpoints"""
+    """A cache of discovered endpoints (by beacon url)"""
+    discovered_expires_in: Optional[float] = Field(
+        default=None,
+        description="After how many seconds a discovered endpoint should be resolved again (None means never)",
+    )
     ssl_context: ssl.SSLContext = Field(
-        default_factory=lambda: ssl.create_default_context(cafile=certifi.where()),
+        default_factory=get_default_ssl_context,
         exclude=True,
     )
     """ An ssl context to use for the connection to the endpoint"""
@@ -209,12 +496,152 @@ class FirstAdvertisedDiscovery(BaseModel):
         default=3,
         description="The timeout for the connection",
     )
+    max_concurrent: int = Field(
+        default=4,
+        ge=1,
+        description="How many advertised endpoints to try to connect to at the same time",
+    )
+
+    _discovered_expiries: Dict[str, float] = PrivateAttr(default_factory=dict)
+    _socket: Optional[socket] = PrivateAttr(default=None)
+    _transport: Optional[asyncio.BaseTransport] = PrivateAttr(default=None)
+    _protocol: Optional[DiscoveryProtocol] = PrivateAttr(default=None)
+    _listener_loop: Optional[asyncio.AbstractEventLoop] = PrivateAttr(default=None)
+    _listener_lock: Optional[asyncio.Lock] = PrivateAttr(default=None)
+    _listener_users: int = PrivateAttr(default=0)
+    _keep_listening: int = PrivateAttr(default=0)
+
+    def _close_listener(self) -> None:
+        """Close the shared listening socket (if it is open)"""
+        if self._transport is not None:
+            try:
+                self._transport.close()
+            except RuntimeError:
+                # the loop of the listener is already closed
+                pass
+        if self._socket is not None:
+            self._socket.close()
+
+        self._socket = None
+        self._transport = None
+        self._protocol = None
+
+    async def _aacquire_protocol(self) -> DiscoveryProtocol:
+        """Get the protocol of the shared listener, opening it if needed
+
+        Every acquired protocol needs to be released with `_release_protocol`.
+        The listener (and its lock) belong to the event loop they were
+        created in, so it is reopened if discovery moves to another loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._listener_lock is None or self._listener_loop is not loop:
+            self._close_listener()
+            self._listener_users = 0
+            self._listener_loop = loop
+            self._listener_lock = asyncio.Lock()
+
+        async with self._listener_lock:
+            if self._transport is None or self._transport.is_closing():
+                self._close_listener()
+
+                s = socket(AF_INET, SOCK_DGRAM)  # create UDP socket
+                try:
+                    s.bind((self.bind, self.broadcast_port))
+                    protocol = DiscoveryProtocol(
+                        self.magic_phrase.encode("utf-8"),
+                        maxlen=MAX_PENDING_DATAGRAMS,
+                    )
+                    transport = await acreate_listener(loop, s, protocol)
+                except BaseException as e:
+                    s.close()
+                    raise e
+
+                self._socket = s
+                self._transport = transport
+                self._protocol = protocol
+
+            assert self._protocol is not None
+            if self._listener_users == 0:
+                # nobody was discovering, these beacons might be stale
+                self._protocol.clear()
+
+            self._listener_users += 1
+            return self._protocol
+
+    def _release_protocol(self, protocol: DiscoveryProtocol) -> None:
+        """Release an acquired protocol, closing the listener if unused
+
+        If the listener of the protocol was already closed (e.g. through
+        `aclose`), there is nothing left to release.
+        """
+        if protocol is not self._protocol:
+            return
+
+        self._listener_users -= 1
+        if self._listener_users == 0 and self._keep_listening == 0:
+            self._close_listener()
+
+    async def aclose(self) -> None:
+        """Close the listening socket
+
+        Running discoveries stop listening for new beacons (and raise a
+        DiscoveryError if none of the received ones can be resolved).
+        The socket will be opened again on the next call to `adiscover`
+        """
+        self._close_listener()
+        self._listener_users = 0
+
+    async def __aenter__(self) -> "FirstAdvertisedDiscovery":
+        """Keep the listening socket open until the context is left"""
+        self._keep_listening += 1
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        """Close the listening socket (unless a discovery is still running)"""
+        self._keep_listening -= 1
+        if self._keep_listening == 0 and self._listener_users == 0:
+            self._close_listener()
+
+    def _get_discovered(self, url: str) -> Optional[FaktsEndpoint]:
+        """Get a previously discovered endpoint, if it has not expired"""
+        endpoint = self.discovered_endpoints.get(url)
+        if endpoint is None:
+            return None
+
+        expires_at = self._discovered_expiries.get(url)
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.discovered_endpoints[url]
+            del self._discovered_expiries[url]
+            return None
+
+        return endpoint
+
+    def _put_discovered(self, url: str, endpoint: FaktsEndpoint) -> None:
+        """Remember a discovered endpoint for the beacon url"""
+        self.discovered_endpoints[url] = endpoint
+        if self.discovered_expires_in is not None:
+            self._discovered_expiries[url] = (
+                time.monotonic() + self.discovered_expires_in
+            )
+
+    async def _aresolve(self, url: str, semaphore: asyncio.Semaphore) -> FaktsEndpoint:
+        """Resolve (and remember) the endpoint of a beacon url"""
+        async with semaphore:
+            endpoint = await discover_url(url, self.ssl_context, timeout=self.timeout)
+
+        self._put_discovered(url, endpoint)
+        return endpoint
 
     async def adiscover(self, request: FaktsRequest) -> FaktsEndpoint:
         """Discover the endpoint
 
-        This method will always return the same endpoint (the one that was
-        passed to the constructor)
+        This method will return the endpoint of the first beacon that
+        can be resolved. Endpoints that were already resolved are taken
+        from `discovered_endpoints` instead of being requested again.
+
+        Every new beacon is resolved right away (with at most
+        `max_concurrent` connections at the same time), so an unresponsive
+        advertiser does not hold up the others.
 
         Parameters
         ----------
@@ -227,20 +654,61 @@ class FirstAdvertisedDiscovery(BaseModel):
             A valid endpoint
         """
 
-        binding = ListenBinding(
-            address=self.bind,
-            port=self.broadcast_port,
-            magic_phrase=self.magic_phrase,
-        )
-        async for beacon in alisten_pure(binding, strict=self.strict):
-            try:
-                endpoint = await discover_url(beacon.url, self.ssl_context)
-                return endpoint
-            except Exception as e:
-                logger.error(f"Could not connect to beacon {beacon.url}: {e}")
-                continue
+        protocol = await self._aacquire_protocol()
+        beacons = _areceive_beacons(protocol, self.strict, self.max_seen)
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        resolving: Dict[asyncio.Future, str] = {}
+        next_beacon: Optional[asyncio.Future] = None
+
+        try:
+            next_beacon = asyncio.ensure_future(beacons.__anext__())
+            while next_beacon is not None or resolving:
+                waiting = set(resolving)
+                if next_beacon is not None:
+                    waiting.add(next_beacon)
+
+                done, _ = await asyncio.wait(
+                    waiting, return_when=asyncio.FIRST_COMPLETED
+                )
+
+                for task in done:
+                    if task in resolving:
+                        url = resolving.pop(task)
+                        try:
+                            return task.result()
+                        except Exception as e:
+                            logger.error(f"Could not connect to beacon {url}: {e}")
+
+                if next_beacon is not None and next_beacon in done:
+                    try:
+                        beacon = next_beacon.result()
+                    except StopAsyncIteration:
+                        next_beacon = None
+                        continue
+
+                    endpoint = self._get_discovered(beacon.url)
+                    if endpoint is not None:
+                        return endpoint
+
+                    task = asyncio.ensure_future(self._aresolve(beacon.url, semaphore))
+                    resolving[task] = beacon.url
+                    next_beacon = asyncio.ensure_future(beacons.__anext__())
+
+            raise DiscoveryError("Could not find any endpoint")
 
-        raise DiscoveryError("Could not find any endpoint")
+        finally:
+            pending = list(resolving)
+            if next_beacon is not None:
+                pending.append(next_beacon)
+
+            for task in pending:
+                task.cancel()
+
+            try:
+                await asyncio.gather(*pending, return_exceptions=True)
+                await beacons.aclose()
+            finally:
+                self._release_protocol(protocol)
 
     class Config:
         """Pydantic Config"""
@@ -11,7 +11,7 @@ from typing import Dict, List
 
 from pydantic import Field
 import ssl
-import certifi
+from fakts.grants.remote.utils import get_default_ssl_context
 from fakts.grants.remote.models import FaktsEndpoint
 
 
@@ -312,7 +312,7 @@ class QtSelectableDiscovery(BaseModel):
     discovered_endpoints: Dict[str, FaktsEndpoint] = Field(default_factory=dict)
     """A cache of discovered endpoints"""
     ssl_context: ssl.SSLContext = Field(
-        default_factory=lambda: ssl.create_default_context(cafile=certifi.where()),
+        default_factory=get_default_ssl_context,
         exclude=True,
     )
     """ An ssl context to use for the connection to the endpoint"""
@@ -1,5 +1,5 @@
 import ssl
-import certifi
+from fakts.grants.remote.utils import get_default_ssl_context
 from pydantic import Field, BaseModel
 import logging
 from typing import List
@@ -27,7 +27,7 @@ class WellKnownDiscovery(BaseModel):
     url: str
     """The url of the well-known endpoint"""
     ssl_context: ssl.SSLContext = Field(
-        default_factory=lambda: ssl.create_default_context(cafile=certifi.where()),
+        default_factory=get_default_ssl_context,
         exclude=True,
     )
     """ An ssl context to use for the connection to the endpoint"""
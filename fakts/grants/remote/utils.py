@@ -0,0 +1,34 @@
+import ssl
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def get_default_ssl_context() -> ssl.SSLContext:
+    """Get the default ssl context for connections to a fakts server
+
+    The context trusts the certifi CA bundle. Loading the bundle is
+    expensive, so the context is only created once and then shared by
+    every discovery, demander and claimer that does not get its own
+    context. Do not modify it, pass your own context instead.
+
+    certifi is only imported on the first call, so importing the remote
+    grants does not pay for it.
+
+    Returns
+    -------
+    ssl.SSLContext
+        The shared default ssl context
+
+    Raises
+    ------
+    ImportError
+        If certifi is not installed
+    """
+    try:
+        import certifi
+    except ImportError as e:
+        raise ImportError(
+            "certifi is required for the default ssl context. please install it seperately or install fakts with the 'remote' extras"
+        ) from e
+
+    return ssl.create_default_context(cafile=certifi.where())
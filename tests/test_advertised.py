@@ -0,0 +1,410 @@
+import asyncio
+import json
+from socket import socket, AF_INET, SOCK_DGRAM
+import pytest
+from pydantic import ValidationError
+from aiohttp import web
+from fakts.grants.remote.discovery import advertised
+from fakts.grants.remote.discovery.advertised import (
+    alisten,
+    BatchedDatagramTransport,
+    ListenBinding,
+    FirstAdvertisedDiscovery,
+    DiscoveryProtocol,
+    _areceive_beacons,
+    _RecentlySeen,
+)
+from fakts.grants.remote.errors import DiscoveryError
+from fakts.grants.remote.models import FaktsEndpoint
+from fakts.models import FaktsRequest
+
+
+@pytest.fixture
+def udp_port() -> int:
+    s = socket(AF_INET, SOCK_DGRAM)
+    try:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+async def send_datagrams(port: int, *messages: bytes):
+    await asyncio.sleep(0.1)
+    s = socket(AF_INET, SOCK_DGRAM)
+    try:
+        for message in messages:
+            s.sendto(message, ("127.0.0.1", port))
+    finally:
+        s.close()
+
+
+@pytest.mark.asyncio
+async def test_listen_skips_foreign_datagrams(udp_port):
+    send_task = asyncio.create_task(
+        send_datagrams(
+            udp_port,
+            b"\xff\xfe not utf8 noise",
+            b'beacon-fakts{"url": 3',
+            b'beacon-fakts{"url": "http://localhost:8000/f/"}',
+        )
+    )
+
+    async for beacon in alisten(ListenBinding(address="127.0.0.1", port=udp_port)):
+        assert beacon.url == "http://localhost:8000/f/"
+        break
+
+    await send_task
+
+
+@pytest.mark.asyncio
+async def test_listen_falls_back_to_datagram_endpoint(monkeypatch, udp_port):
+    def add_reader(*args):
+        raise NotImplementedError()
+
+    monkeypatch.setattr(asyncio.get_running_loop(), "add_reader", add_reader)
+    send_task = asyncio.create_task(
+        send_datagrams(udp_port, b'beacon-fakts{"url": "http://a/"}')
+    )
+
+    async for beacon in alisten(ListenBinding(address="127.0.0.1", port=udp_port)):
+        assert beacon.url == "http://a/"
+        break
+
+    await send_task
+
+
+@pytest.mark.asyncio
+async def test_listen_raises_when_port_is_taken(udp_port):
+    taken = socket(AF_INET, SOCK_DGRAM)
+    taken.bind(("127.0.0.1", udp_port))
+    try:
+        with pytest.raises(OSError):
+            async for beacon in alisten(
+                ListenBinding(address="127.0.0.1", port=udp_port)
+            ):
+                pass
+    finally:
+        taken.close()
+
+
+@pytest.mark.asyncio
+async def test_listen_closes_socket_when_setup_fails(monkeypatch, udp_port):
+    sockets = []
+
+    async def acreate_listener(loop, sock, protocol):
+        sockets.append(sock)
+        raise RuntimeError("no listener")
+
+    monkeypatch.setattr(advertised, "acreate_listener", acreate_listener)
+
+    with pytest.raises(RuntimeError, match="no listener"):
+        async for beacon in alisten(ListenBinding(address="127.0.0.1", port=udp_port)):
+            pass
+
+    assert sockets[0].fileno() == -1
+    assert port_is_free(udp_port)
+
+
+class RecordingProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.received = []
+
+    def datagram_received(self, data, addr):
+        self.received.append(data)
+
+
+class ManualLoop:
+    def add_reader(self, fd, callback):
+        self.reader = callback
+
+    def remove_reader(self, fd):
+        self.reader = None
+
+    def call_soon(self, callback, *args):
+        callback(*args)
+
+
+def test_transport_drains_at_most_a_batch(udp_port):
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.bind(("127.0.0.1", udp_port))
+    sock.setblocking(False)
+    loop = ManualLoop()
+    protocol = RecordingProtocol()
+    transport = BatchedDatagramTransport(loop, sock, protocol, max_batch=2)
+
+    sender = socket(AF_INET, SOCK_DGRAM)
+    try:
+        for i in range(5):
+            sender.sendto(b"%d" % i, ("127.0.0.1", udp_port))
+
+        batches = []
+        for _ in range(4):
+            loop.reader()
+            batches.append(len(protocol.received))
+
+        assert batches == [2, 4, 5, 5]
+        assert protocol.received == [b"0", b"1", b"2", b"3", b"4"]
+    finally:
+        transport.close()
+        sender.close()
+        sock.close()
+
+
+async def start_fakts_server() -> web.AppRunner:
+    async def well_known(request):
+        return web.json_response({"name": "test", "base_url": "http://test/f/"})
+
+    async def slow_well_known(request):
+        await asyncio.sleep(3)
+        return await well_known(request)
+
+    app = web.Application()
+    app.router.add_get("/f/.well-known/fakts", well_known)
+    app.router.add_get("/slow/.well-known/fakts", slow_well_known)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+def port_is_free(port: int) -> bool:
+    s = socket(AF_INET, SOCK_DGRAM)
+    try:
+        s.bind(("127.0.0.1", port))
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+@pytest.fixture
+def resolved_urls(monkeypatch):
+    urls = []
+
+    async def fake_discover_url(url, ssl_context, timeout):
+        assert timeout == 3
+        urls.append(url)
+        return FaktsEndpoint(name=url)
+
+    monkeypatch.setattr(advertised, "discover_url", fake_discover_url)
+    return urls
+
+
+async def discover_with(discovery, *messages: bytes):
+    send_task = asyncio.create_task(send_datagrams(discovery.broadcast_port, *messages))
+    try:
+        return await asyncio.wait_for(
+            discovery.adiscover(FaktsRequest(context={})), timeout=2
+        )
+    finally:
+        await send_task
+
+
+@pytest.mark.asyncio
+async def test_discovery_releases_port(resolved_urls, udp_port):
+    discovery = FirstAdvertisedDiscovery(bind="127.0.0.1", broadcast_port=udp_port)
+
+    endpoint = await discover_with(discovery, b'beacon-fakts{"url": "http://a/"}')
+    assert endpoint.name == "http://a/"
+    assert port_is_free(udp_port)
+
+
+@pytest.mark.asyncio
+async def test_discovery_keeps_listening_in_context(resolved_urls, udp_port):
+    discovery = FirstAdvertisedDiscovery(bind="127.0.0.1", broadcast_port=udp_port)
+
+    async with discovery:
+        await discover_with(discovery, b'beacon-fakts{"url": "http://a/"}')
+        assert not port_is_free(udp_port)
+
+        # received while nobody is discovering, and should not be replayed
+        await send_datagrams(udp_port, b'beacon-fakts{"url": "http://gone/"}')
+        await asyncio.sleep(0.1)
+
+        endpoint = await discover_with(discovery, b'beacon-fakts{"url": "http://b/"}')
+        assert endpoint.name == "http://b/"
+
+    assert port_is_free(udp_port)
+    assert resolved_urls == ["http://a/", "http://b/"]
+
+
+@pytest.mark.asyncio
+async def test_discovery_does_not_wait_for_slow_beacons(udp_port):
+    runner = await start_fakts_server()
+    http_port = runner.addresses[0][1]
+    discovery = FirstAdvertisedDiscovery(bind="127.0.0.1", broadcast_port=udp_port)
+
+    send_task = asyncio.create_task(
+        send_datagrams(
+            udp_port,
+            b'beacon-fakts{"url": "http://127.0.0.1:%d/slow/"}' % http_port,
+            b'beacon-fakts{"url": "http://127.0.0.1:%d/f/"}' % http_port,
+        )
+    )
+
+    try:
+        endpoint = await asyncio.wait_for(
+            discovery.adiscover(FaktsRequest(context={})), timeout=2
+        )
+        assert endpoint.name == "test"
+        await send_task
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_discoveries_see_every_beacon(resolved_urls, udp_port):
+    discovery = FirstAdvertisedDiscovery(bind="127.0.0.1", broadcast_port=udp_port)
+
+    endpoints = await asyncio.gather(
+        discover_with(discovery, b'beacon-fakts{"url": "http://a/"}'),
+        asyncio.wait_for(discovery.adiscover(FaktsRequest(context={})), timeout=2),
+    )
+
+    assert [endpoint.name for endpoint in endpoints] == ["http://a/", "http://a/"]
+    assert port_is_free(udp_port)
+
+
+@pytest.mark.asyncio
+async def test_discovery_stops_when_closed(resolved_urls, udp_port):
+    discovery = FirstAdvertisedDiscovery(bind="127.0.0.1", broadcast_port=udp_port)
+
+    running = asyncio.create_task(discovery.adiscover(FaktsRequest(context={})))
+    await asyncio.sleep(0.1)
+    await discovery.aclose()
+
+    with pytest.raises(DiscoveryError):
+        await asyncio.wait_for(running, timeout=2)
+
+    endpoint = await discover_with(discovery, b'beacon-fakts{"url": "http://a/"}')
+    assert endpoint.name == "http://a/"
+    assert port_is_free(udp_port)
+
+
+@pytest.mark.asyncio
+async def test_discovery_binds_updated_port(resolved_urls, udp_port):
+    discovery = FirstAdvertisedDiscovery(bind="127.0.0.1", broadcast_port=0)
+    discovery.broadcast_port = udp_port
+
+    async with discovery:
+        endpoint = await discover_with(discovery, b'beacon-fakts{"url": "http://a/"}')
+        assert endpoint.name == "http://a/"
+        assert not port_is_free(udp_port)
+
+
+def test_recently_seen_forgets_least_recently_seen():
+    seen = _RecentlySeen(2)
+    assert not seen.check_and_add(1)
+    assert not seen.check_and_add(2)
+    assert seen.check_and_add(1)  # 1 is now the most recently seen
+    assert not seen.check_and_add(3)  # forgets 2
+    assert seen.check_and_add(1)
+    assert not seen.check_and_add(2)
+
+
+async def receive_urls(max_seen: int, *urls: str):
+    protocol = DiscoveryProtocol(b"beacon-fakts")
+    for url in urls + ("http://sentinel/",):
+        protocol.datagram_received(
+            b'beacon-fakts{"url": "%s"}' % url.encode(), ("127.0.0.1", 0)
+        )
+
+    received = []
+    async for beacon in _areceive_beacons(protocol, max_seen=max_seen):
+        if beacon.url == "http://sentinel/":
+            return received
+        received.append(beacon.url)
+
+
+@pytest.mark.asyncio
+async def test_receive_yields_evicted_url_again():
+    urls = await receive_urls(2, "http://a/", "http://b/", "http://c/", "http://a/")
+    assert urls == ["http://a/", "http://b/", "http://c/", "http://a/"]
+
+
+@pytest.mark.asyncio
+async def test_receive_keeps_recently_repeated_url():
+    urls = await receive_urls(
+        2, "http://a/", "http://b/", "http://a/", "http://c/", "http://a/"
+    )
+    assert urls == ["http://a/", "http://b/", "http://c/"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "expires_in, expected",
+    [
+        (None, ["http://a/"]),
+        (60, ["http://a/"]),
+        (0.05, ["http://a/", "http://a/"]),
+    ],
+)
+async def test_discovery_caches_resolved_endpoints(
+    resolved_urls, udp_port, expires_in, expected
+):
+    discovery = FirstAdvertisedDiscovery(
+        bind="127.0.0.1", broadcast_port=udp_port, discovered_expires_in=expires_in
+    )
+
+    for _ in range(2):
+        endpoint = await discover_with(discovery, b'beacon-fakts{"url": "http://a/"}')
+        assert endpoint.name == "http://a/"
+        await asyncio.sleep(0.1)
+
+    assert resolved_urls == expected
+
+
+async def receive_payloads(*payloads: bytes):
+    protocol = DiscoveryProtocol(b"beacon-fakts")
+    for payload in payloads + (b'beacon-fakts{"url": "http://sentinel/"}',):
+        protocol.datagram_received(payload, ("127.0.0.1", 0))
+
+    received = []
+    async for beacon in _areceive_beacons(protocol, max_seen=10):
+        if beacon.url == "http://sentinel/":
+            return received
+        received.append(beacon.url)
+
+
+@pytest.mark.asyncio
+async def test_receive_parses_repeated_payload_once(monkeypatch):
+    parsed = []
+    json_loads = advertised.json_loads
+
+    def counting_json_loads(payload):
+        parsed.append(bytes(payload))
+        return json_loads(payload)
+
+    monkeypatch.setattr(advertised, "json_loads", counting_json_loads)
+
+    beacon = b'beacon-fakts{"url": "http://a/"}'
+    urls = await receive_payloads(beacon, beacon, beacon)
+
+    assert urls == ["http://a/"]
+    assert parsed.count(b'{"url": "http://a/"}') == 1
+
+
+@pytest.mark.asyncio
+async def test_receive_logs_repeated_malformed_payload_once(caplog):
+    malformed = b'beacon-fakts{"url": 3'
+    urls = await receive_payloads(malformed, malformed, malformed)
+
+    assert urls == []
+    assert caplog.text.count("not a valid beacon") == 1
+
+
+@pytest.mark.asyncio
+async def test_receive_skips_deeply_nested_payload(monkeypatch):
+    monkeypatch.setattr(
+        advertised, "json_loads", lambda payload: json.loads(bytes(payload))
+    )
+
+    urls = await receive_payloads(b"beacon-fakts" + b"[" * 5000)
+    assert urls == []
+
+
+def test_discovery_needs_a_concurrent_connection():
+    with pytest.raises(ValidationError):
+        FirstAdvertisedDiscovery(max_concurrent=0)
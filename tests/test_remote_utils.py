@@ -0,0 +1,22 @@
+import sys
+import pytest
+from fakts.grants.remote.discovery.advertised import FirstAdvertisedDiscovery
+from fakts.grants.remote.utils import get_default_ssl_context
+
+
+def test_default_ssl_context_is_shared():
+    assert get_default_ssl_context() is get_default_ssl_context()
+
+    first = FirstAdvertisedDiscovery()
+    second = FirstAdvertisedDiscovery()
+    assert first.ssl_context is second.ssl_context
+
+
+def test_default_ssl_context_needs_certifi(monkeypatch):
+    get_default_ssl_context.cache_clear()
+    monkeypatch.setitem(sys.modules, "certifi", None)
+    try:
+        with pytest.raises(ImportError, match="certifi is required"):
+            get_default_ssl_context()
+    finally:
+        get_default_ssl_context.cache_clear()